@@ -0,0 +1,69 @@
+import torch as th
+
+from tuned_lens.scripts.train_loop import _graphed, _zero_missing_grads
+
+
+class _StaticGradMul(th.autograd.Function):
+    """Multiply by a weight, returning its gradient in a reused static buffer.
+
+    This mimics the backward pass of `th.cuda.make_graphed_callables`.
+    """
+
+    static_grad = th.zeros(3)
+
+    @staticmethod
+    def forward(ctx, x, weight):
+        ctx.save_for_backward(x)
+        return x * weight
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        (x,) = ctx.saved_tensors
+        _StaticGradMul.static_grad.copy_(grad_output * x)
+        return None, _StaticGradMul.static_grad.detach()
+
+
+def test_graphed_falls_back_to_eager_on_new_shapes(monkeypatch):
+    captures, replays, eager_calls = [], [], []
+
+    def make_graphed_callables(module, sample_args):
+        captures.append(sample_args)
+
+        def replay(*args):
+            replays.append(args)
+            return module(*args)
+
+        return replay
+
+    def layer_losses(lens, hidden_states, labels, shift):
+        eager_calls.append(shift)
+        return th.stack([lens(h).sum() for h in hidden_states])
+
+    monkeypatch.setattr(th.cuda, "make_graphed_callables", make_graphed_callables)
+    wrapper = _graphed(layer_losses)
+    lens = th.nn.Linear(4, 4)
+    labels = th.zeros(2, dtype=th.long)
+
+    for _ in range(2):
+        losses = wrapper(lens, [th.randn(2, 4), th.randn(2, 4)], labels, 1)
+        assert losses.shape == (2,)
+
+    wrapper(lens, [th.randn(3, 4), th.randn(3, 4)], labels, 1)
+    assert len(captures) == 1
+    assert len(replays) == 2
+    # Two calls from the replays, and one eager call for the new shapes
+    assert len(eager_calls) == 3
+
+
+def test_zero_missing_grads_accumulates_static_grads():
+    weight = th.nn.Parameter(th.ones(3))
+    module = th.nn.Module()
+    module.weight = weight
+
+    x1, x2 = th.tensor([1.0, 2.0, 3.0]), th.tensor([4.0, 5.0, 6.0])
+    for x in (x1, x2):
+        _zero_missing_grads(module)
+        _StaticGradMul.apply(x, weight).sum().backward()
+
+    assert weight.grad.data_ptr() != _StaticGradMul.static_grad.data_ptr()
+    assert th.equal(weight.grad, x1 + x2)
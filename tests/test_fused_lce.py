@@ -0,0 +1,87 @@
+import pytest
+import torch as th
+
+from tuned_lens.nn import fused_lce
+from tuned_lens.nn.fused_lce import linear_cross_entropy, linear_kl_divergence
+
+
+@pytest.mark.parametrize("bias", [True, False])
+def test_linear_cross_entropy(bias: bool):
+    th.manual_seed(42)
+    h = th.randn(2, 5, 16, dtype=th.float64, requires_grad=True)
+    weight = th.randn(37, 16, dtype=th.float64, requires_grad=True)
+    b = th.randn(37, dtype=th.float64, requires_grad=True) if bias else None
+    labels = th.randint(0, 37, (2, 5))
+
+    loss = linear_cross_entropy(h, weight, b, labels, chunk_size=8)
+    expected = th.nn.functional.cross_entropy(
+        th.nn.functional.linear(h, weight, b).flatten(0, -2), labels.flatten()
+    )
+    assert th.allclose(loss, expected)
+
+    inputs = [h, weight] + ([b] if b is not None else [])
+    grads = th.autograd.grad(loss, inputs)
+    expected_grads = th.autograd.grad(expected, inputs)
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert th.allclose(grad, expected_grad)
+
+
+def test_linear_cross_entropy_ignore_index():
+    th.manual_seed(42)
+    h = th.randn(2, 5, 16, dtype=th.float64, requires_grad=True)
+    weight = th.randn(37, 16, dtype=th.float64, requires_grad=True)
+    labels = th.randint(0, 37, (2, 5))
+    labels[0, :3] = -100
+
+    loss = linear_cross_entropy(h, weight, None, labels, chunk_size=8)
+    expected = th.nn.functional.cross_entropy(
+        th.nn.functional.linear(h, weight).flatten(0, -2), labels.flatten()
+    )
+    assert th.allclose(loss, expected)
+
+    grads = th.autograd.grad(loss, [h, weight])
+    expected_grads = th.autograd.grad(expected, [h, weight])
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert th.allclose(grad, expected_grad)
+    assert not grads[0][0, :3].any()
+
+
+def test_linear_kl_divergence():
+    th.manual_seed(42)
+    h = th.randn(2, 5, 16, dtype=th.float64, requires_grad=True)
+    weight = th.randn(37, 16, dtype=th.float64, requires_grad=True)
+    target = th.randn(2, 5, 37, dtype=th.float64).log_softmax(-1)
+
+    loss = linear_kl_divergence(h, weight, None, target, chunk_size=8)
+    logits = th.nn.functional.linear(h, weight)
+    expected = th.sum(target.exp() * (target - logits.log_softmax(-1)), dim=-1).mean()
+    assert th.allclose(loss, expected)
+
+    grads = th.autograd.grad(loss, [h, weight])
+    expected_grads = th.autograd.grad(expected, [h, weight])
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert th.allclose(grad, expected_grad)
+
+
+@pytest.mark.parametrize("batched", [True, False])
+def test_linear_cross_entropy_grouped(monkeypatch, batched: bool):
+    if batched:
+        # Only leave room for the logits of one group at a time
+        monkeypatch.setattr(fused_lce, "_MAX_CHUNK_NUMEL", 10 * 8)
+
+    th.manual_seed(42)
+    h = th.randn(3, 2, 5, 16, dtype=th.float64, requires_grad=True)
+    weight = th.randn(37, 16, dtype=th.float64, requires_grad=True)
+    labels = th.randint(0, 37, (2, 5))
+
+    losses = linear_cross_entropy(h, weight, None, labels, chunk_size=8)
+    expected = th.stack(
+        [linear_cross_entropy(h_i, weight, None, labels, chunk_size=8) for h_i in h]
+    )
+    assert losses.shape == (3,)
+    assert th.allclose(losses, expected)
+
+    grads = th.autograd.grad(losses.sum(), [h, weight])
+    expected_grads = th.autograd.grad(expected.sum(), [h, weight])
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert th.allclose(grad, expected_grad)
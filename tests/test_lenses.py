@@ -62,6 +62,15 @@ def random_tuned_lens(tuned_lens_config, unembed):
     return tuned_lens
 
 
+def test_tuned_lens_config_from_dict_ignores_unknown_keys(
+    tuned_lens_config: TunedLensConfig,
+):
+    config_dict = {**tuned_lens_config.to_dict(), "unknown_key": 1}
+    config = TunedLensConfig.from_dict(config_dict)
+    assert config == tuned_lens_config
+    assert "unknown_key" in config_dict, "Don't mutate the input dictionary!"
+
+
 def test_logit_lens_smoke(logit_lens):
     randn = th.randn(1, 10, 128)
     logit_lens(randn, 0)
@@ -79,6 +88,50 @@ def test_tuned_lens_forward(random_tuned_lens: TunedLens):
     assert th.allclose(logits_forward, logits)
 
 
+def test_tuned_lens_getitem_is_a_differentiable_view(random_tuned_lens: TunedLens):
+    translator = random_tuned_lens[1]
+    assert list(translator.parameters()) == []
+
+    translator(th.randn(2, 128)).sum().backward()
+    assert random_tuned_lens.weight.grad is not None
+    assert random_tuned_lens.weight.grad[1].any()
+    assert not random_tuned_lens.weight.grad[[0, 2]].any()
+
+    with pytest.warns(DeprecationWarning):
+        assert len(random_tuned_lens.layer_translators) == len(random_tuned_lens)
+
+
+def test_tuned_lens_transform_hidden_all(random_tuned_lens: TunedLens):
+    with th.no_grad():
+        random_tuned_lens.weight.normal_()
+        random_tuned_lens.bias.normal_()
+
+    randn = th.randn(3, 2, 10, 128)
+    transformed = random_tuned_lens.transform_hidden_all(randn)
+    for i in range(3):
+        expected = random_tuned_lens.transform_hidden(randn[i], i)
+        assert th.allclose(transformed[i], expected, atol=1e-4)
+
+
+def test_tuned_lens_loads_legacy_state_dict(random_small_model: trf.PreTrainedModel):
+    tuned_lens = TunedLens.from_model(random_small_model)
+    with th.no_grad():
+        tuned_lens.weight.normal_()
+        tuned_lens.bias.normal_()
+
+    # Snapshots used to store the translators as a `layer_translators` ModuleList
+    state = tuned_lens.state_dict()
+    weight, bias = state.pop("weight"), state.pop("bias")
+    for i in range(len(tuned_lens)):
+        state[f"layer_translators.{i}.weight"] = weight[i]
+        state[f"layer_translators.{i}.bias"] = bias[i]
+
+    reloaded = TunedLens.from_model(random_small_model)
+    reloaded.load_state_dict(state)
+    assert th.equal(reloaded.weight, tuned_lens.weight)
+    assert th.equal(reloaded.bias, tuned_lens.bias)
+
+
 def test_tuned_lens_save_and_load(
     unembed: Unembed, random_tuned_lens: TunedLens, tmp_path: Path
 ):
@@ -93,6 +146,18 @@ def test_tuned_lens_save_and_load(
     assert th.allclose(logits_before, logits_after)
 
 
+def test_tuned_lens_saves_in_unembedding_dtype(
+    random_tuned_lens: TunedLens, tmp_path: Path
+):
+    # Upcast the translators like the training loop does with its master weights
+    for p in (random_tuned_lens.weight, random_tuned_lens.bias):
+        p.data = p.data.double()
+
+    random_tuned_lens.save(tmp_path)
+    state = th.load(tmp_path / "params.pt")
+    assert all(v.dtype == th.float32 for v in state.values())
+
+
 def test_from_model_and_pretrained_propogates_kwargs(
     random_tuned_lens: TunedLens, unembed: Unembed, tmp_path: Path
 ):
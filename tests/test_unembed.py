@@ -29,3 +29,21 @@ def test_correctness(random_small_model: tr.PreTrainedModel):
 
     x_hat = back_translate(unembed, x, tol=1e-5)
     th.testing.assert_close(y.exp(), unembed(x_hat).softmax(-1), atol=5e-4, rtol=0.01)
+
+
+def test_unembedding_hash_cache(random_small_model: tr.PreTrainedModel):
+    unembed = Unembed(random_small_model)
+    hash_before = unembed.unembedding_hash()
+    assert unembed.unembedding_hash() == hash_before
+
+    # Loading new weights invalidates the cache
+    state = {k: v * 2.0 for k, v in unembed.state_dict().items()}
+    unembed.load_state_dict(state)
+    hash_loaded = unembed.unembedding_hash()
+    assert hash_loaded != hash_before
+
+    # So does modifying the weight in place
+    with th.no_grad():
+        unembed.unembedding.weight.mul_(2.0)
+
+    assert unembed.unembedding_hash() != hash_loaded
@@ -1,4 +1,5 @@
 """A set of PyTorch modules for transforming the residual streams of models."""
+from .fused_lce import linear_cross_entropy, linear_kl_divergence
 from .lenses import Lens, LogitLens, TunedLens, TunedLensConfig
 from .unembed import (
     InversionOutput,
@@ -0,0 +1,248 @@
+"""Fused unembedding and loss computations that never materialize the full logits."""
+import math
+from typing import Optional
+
+import torch as th
+
+# Bounds on the default width of the vocabulary chunks. Narrower chunks turn the loss
+# into many small, launch-bound matmuls.
+_MIN_CHUNK_SIZE = 2048
+_MAX_CHUNK_SIZE = 8192
+# Default upper bound on the number of logits alive at once, 256 MB in float32
+_MAX_CHUNK_NUMEL = 2**26
+
+
+class _LinearCrossEntropy(th.autograd.Function):
+    """Cross entropy or KL divergence of `h @ weight.T + bias` against a target.
+
+    `h` has shape `(G x N x d)` and holds G groups of N rows which share the same
+    N targets, so all groups are unembedded together. The result is the mean loss
+    over the rows of each group, weighted by `row_weight`, with shape `(G,)`.
+
+    The logits are computed in chunks along the vocabulary dimension. The forward pass
+    keeps a running logsumexp per row, and the backward pass recomputes each chunk of
+    logits to produce the gradients, so at most `(G x N x chunk_size)` logits are
+    alive at any time.
+    """
+
+    @staticmethod
+    def forward(
+        ctx,
+        h: th.Tensor,
+        weight: th.Tensor,
+        bias: Optional[th.Tensor],
+        target: th.Tensor,
+        row_weight: th.Tensor,
+        kl: bool,
+        chunk_size: int,
+    ) -> th.Tensor:
+        with th.autocast(h.device.type, enabled=False):
+            acc_dtype = _accumulation_dtype(h)
+            lse = h.new_full(h.shape[:-1], -th.inf, dtype=acc_dtype)
+            # The logit of the label for CE, or the target-weighted mean logit for KL
+            target_logit = h.new_zeros(h.shape[:-1], dtype=acc_dtype)
+            # Negative entropy of the target distribution, only needed for KL
+            neg_entropy = h.new_zeros(h.shape[1:-1], dtype=acc_dtype)
+
+            for start in range(0, len(weight), chunk_size):
+                logits = _logits_chunk(h, weight, bias, start, chunk_size)
+                lse = th.logaddexp(lse, logits.logsumexp(dim=-1))
+
+                if kl:
+                    log_p = target[:, start : start + chunk_size]
+                    p = log_p.exp()
+                    target_logit += th.sum(p * logits, dim=-1)
+                    neg_entropy += th.sum(p * log_p, dim=-1)
+                else:
+                    idx, in_chunk = _labels_in_chunk(target, start, logits.shape[-1])
+                    idx = idx.expand(len(h), -1).unsqueeze(-1)
+                    label_logits = logits.gather(-1, idx).squeeze(-1)
+                    target_logit += label_logits.masked_fill(~in_chunk, 0.0)
+
+        ctx.save_for_backward(h, weight, bias, target, row_weight, lse)
+        ctx.kl = kl
+        ctx.chunk_size = chunk_size
+
+        # For KL this relies on the target probabilities summing to one
+        return th.sum((neg_entropy + lse - target_logit) * row_weight, dim=-1)
+
+    @staticmethod
+    def backward(ctx, grad_output: th.Tensor):
+        h, weight, bias, target, row_weight, lse = ctx.saved_tensors
+        chunk_size = ctx.chunk_size
+        need_h, need_weight, need_bias = ctx.needs_input_grad[:3]
+
+        grad_h = th.zeros_like(h, dtype=_accumulation_dtype(h)) if need_h else None
+        grad_weight = th.zeros_like(weight) if need_weight else None
+        grad_bias = th.zeros_like(bias) if need_bias else None
+        # The loss of each group is a weighted mean over its rows
+        scale = grad_output.view(-1, 1, 1) * row_weight.view(1, -1, 1)
+
+        with th.autocast(h.device.type, enabled=False):
+            h_flat = h.flatten(0, 1)
+            for start in range(0, len(weight), chunk_size):
+                logits = _logits_chunk(h, weight, bias, start, chunk_size)
+
+                # d(loss) / d(logits) is softmax(logits) - target distribution
+                grad_logits = th.exp(logits - lse.unsqueeze(-1))
+                if ctx.kl:
+                    grad_logits -= target[:, start : start + chunk_size].exp()
+                else:
+                    idx, in_chunk = _labels_in_chunk(target, start, logits.shape[-1])
+                    grad_logits.scatter_add_(
+                        -1,
+                        idx.expand(len(h), -1).unsqueeze(-1),
+                        -in_chunk.to(grad_logits).expand(len(h), -1).unsqueeze(-1),
+                    )
+                grad_logits = (grad_logits * scale).to(h.dtype).flatten(0, 1)
+
+                w = weight[start : start + chunk_size]
+                if grad_h is not None:
+                    grad_h += (grad_logits @ w.to(h.dtype)).view_as(h)
+                if grad_weight is not None:
+                    grad_weight[start : start + chunk_size] = grad_logits.T @ h_flat
+                if grad_bias is not None:
+                    grad_bias[start : start + chunk_size] = grad_logits.sum(0)
+
+        if grad_h is not None:
+            grad_h = grad_h.to(h.dtype)
+
+        return grad_h, grad_weight, grad_bias, None, None, None, None
+
+
+def _accumulation_dtype(h: th.Tensor) -> th.dtype:
+    """Get the dtype to accumulate softmax statistics and gradients in."""
+    return th.promote_types(h.dtype, th.float32)
+
+
+def _logits_chunk(
+    h: th.Tensor,
+    weight: th.Tensor,
+    bias: Optional[th.Tensor],
+    start: int,
+    chunk_size: int,
+) -> th.Tensor:
+    """Compute the logits for vocabulary entries `[start, start + chunk_size)`."""
+    w = weight[start : start + chunk_size].to(h.dtype)
+    b = bias[start : start + chunk_size].to(h.dtype) if bias is not None else None
+    return th.nn.functional.linear(h, w, b).to(_accumulation_dtype(h))
+
+
+def _labels_in_chunk(
+    labels: th.Tensor, start: int, size: int
+) -> tuple[th.Tensor, th.Tensor]:
+    """Get the labels' indices within a vocabulary chunk and whether they are in it."""
+    idx = labels - start
+    in_chunk = (idx >= 0) & (idx < size)
+    return idx.clamp(0, size - 1), in_chunk
+
+
+def _apply(
+    h: th.Tensor,
+    weight: th.Tensor,
+    bias: Optional[th.Tensor],
+    target: th.Tensor,
+    target_ndim: int,
+    kl: bool,
+    chunk_size: Optional[int],
+    ignore_index: Optional[int] = None,
+) -> th.Tensor:
+    """Group the leading dims of `h` that the target is broadcast over and apply."""
+    group_shape = h.shape[: h.ndim - 1 - target_ndim]
+    h = h.reshape(math.prod(group_shape), -1, h.shape[-1])
+    target = target.reshape(-1, *target.shape[target_ndim:])
+
+    acc_dtype = _accumulation_dtype(h)
+    if ignore_index is None:
+        row_weight = h.new_full(target.shape[:1], 1 / len(target), dtype=acc_dtype)
+    else:
+        # Like `F.cross_entropy`, ignored rows don't count towards the mean
+        valid = (target != ignore_index).to(acc_dtype)
+        row_weight = valid / valid.sum()
+
+    num_groups, num_rows = h.shape[:2]
+    if chunk_size is None:
+        # Use the widest chunks that fit in the budget, rounded to a multiple of 128
+        chunk_size = _MAX_CHUNK_NUMEL // (num_groups * num_rows) // 128 * 128
+        chunk_size = min(max(chunk_size, _MIN_CHUNK_SIZE), _MAX_CHUNK_SIZE)
+
+    # If even the narrowest chunks of all groups don't fit in the budget, unembed the
+    # groups in batches rather than shrinking the chunks any further
+    groups_per_batch = max(1, _MAX_CHUNK_NUMEL // (num_rows * chunk_size))
+    losses = th.cat(
+        [
+            _LinearCrossEntropy.apply(
+                h_batch, weight, bias, target, row_weight, kl, chunk_size
+            )
+            for h_batch in h.split(groups_per_batch)
+        ]
+    )
+    return losses.view(group_shape)
+
+
+def linear_cross_entropy(
+    h: th.Tensor,
+    weight: th.Tensor,
+    bias: Optional[th.Tensor],
+    labels: th.Tensor,
+    chunk_size: Optional[int] = None,
+    ignore_index: int = -100,
+) -> th.Tensor:
+    """Cross entropy of the logits `h @ weight.T + bias` without materializing them.
+
+    Equivalent to `F.cross_entropy(F.linear(h, weight, bias).flatten(0, -2),
+    labels.flatten(), ignore_index=ignore_index)` when `h` has one more dimension than
+    `labels`. Any extra leading dimensions of `h`, e.g. a layer dimension, are
+    broadcast against the labels and unembedded together, with one loss per index.
+    Matmuls are computed in the dtype of `h`, while the softmax statistics are
+    accumulated in at least float32.
+
+    Args:
+        h: (*extra_dims x ... x d_model) hidden states.
+        weight: (vocab_size x d_model) unembedding matrix.
+        bias: Optional (vocab_size) unembedding bias.
+        labels: (...) integer class labels. Labels other than `ignore_index` must be
+            in `[0, vocab_size)`; they are not validated.
+        chunk_size: Number of vocabulary entries to compute logits for at once.
+            Defaults to the widest multiple of 128 between 2048 and 8192 which keeps
+            about 2 ** 26 logits alive at a time. If the extra dims don't fit even
+            then, they are unembedded in batches.
+        ignore_index: Label of positions which don't contribute to the loss or the
+            mean over positions.
+
+    Returns:
+        The mean cross entropy loss over the positions which aren't ignored, with
+        shape `extra_dims`.
+    """
+    return _apply(h, weight, bias, labels, labels.ndim, False, chunk_size, ignore_index)
+
+
+def linear_kl_divergence(
+    h: th.Tensor,
+    weight: th.Tensor,
+    bias: Optional[th.Tensor],
+    target: th.Tensor,
+    chunk_size: Optional[int] = None,
+) -> th.Tensor:
+    """KL divergence from a target to the logits `h @ weight.T + bias`.
+
+    Computes the mean over positions of `KL(p || softmax(h @ weight.T + bias))`
+    without materializing the logits. Any extra leading dimensions of `h`, e.g. a
+    layer dimension, are broadcast against the target and unembedded together, with
+    one loss per index. Matmuls are computed in the dtype of `h`, while the softmax
+    statistics are accumulated in at least float32.
+
+    Args:
+        h: (*extra_dims x ... x d_model) hidden states.
+        weight: (vocab_size x d_model) unembedding matrix.
+        bias: Optional (vocab_size) unembedding bias.
+        target: (... x vocab_size) log probabilities of the target distribution p.
+        chunk_size: Number of vocabulary entries to compute logits for at once.
+            Defaults to the widest multiple of 128 between 2048 and 8192 which keeps
+            about 2 ** 26 logits alive at a time. If the extra dims don't fit even
+            then, they are unembedded in batches.
+
+    Returns:
+        The mean KL divergence, with shape `extra_dims`.
+    """
+    return _apply(h, weight, bias, target, target.ndim - 1, True, chunk_size)
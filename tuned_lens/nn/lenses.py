@@ -3,7 +3,7 @@ import abc
 import inspect
 import json
 import logging
-from copy import deepcopy
+import warnings
 from dataclasses import asdict, dataclass
 from pathlib import Path
 from typing import Dict, Generator, Optional, Union
@@ -16,6 +16,29 @@ from tuned_lens.nn.unembed import Unembed
 
 logger = logging.getLogger(__name__)
 
+# Memory mapping checkpoints requires PyTorch 2.1 or newer
+_th_load_supports_mmap = "mmap" in inspect.signature(th.load).parameters
+
+
+def _add_residual(delta: th.Tensor, h: th.Tensor) -> th.Tensor:
+    """Compute `h + delta`, writing into the buffer of `delta` when possible.
+
+    The addition is done in place only when it wouldn't lower the precision of the
+    result, e.g. when `delta` is the bfloat16 output of a matmul under autocast and `h`
+    is float32.
+    """
+    if th.result_type(delta, h) == delta.dtype:
+        return delta.add_(h)
+
+    return h + delta
+
+
+def _translator_dtype(unembed: Unembed) -> th.dtype:
+    """Get the dtype of the translators of a lens for the given unembedding."""
+    # The unembedding might be int8 if we're using bitsandbytes
+    w = unembed.unembedding.weight
+    return w.dtype if th.is_floating_point(w) else th.float16
+
 
 class Lens(abc.ABC, th.nn.Module):
     """Abstract base class for all Lens."""
@@ -119,14 +142,46 @@ class TunedLensConfig:
     @classmethod
     def from_dict(cls, config_dict: Dict):
         """Create a config from a dictionary."""
-        config_dict = deepcopy(config_dict)
-        # Drop unrecognized config keys
-        unrecognized = set(config_dict) - set(inspect.getfullargspec(cls).args)
-        for key in unrecognized:
+        # Drop unrecognized config keys. The values are all JSON scalars, so we don't
+        # need to copy them to avoid mutating the caller's dictionary.
+        recognized = set(inspect.getfullargspec(cls).args)
+        for key in config_dict.keys() - recognized:
             logger.warning(f"Ignoring config key '{key}'")
-            del config_dict[key]
 
-        return cls(**config_dict)
+        return cls(**{k: v for k, v in config_dict.items() if k in recognized})
+
+
+class _TranslatorView(th.nn.Module):
+    """The translator of a single layer, as a view into the stacked lens parameters.
+
+    The view has no parameters of its own. Its `weight` and `bias` are indexed out of
+    the stacked parameters of the lens whenever they are accessed, so gradients flow
+    back to the lens through its forward pass.
+    """
+
+    def __init__(
+        self, weight: th.nn.Parameter, bias: Optional[th.nn.Parameter], idx: int
+    ):
+        super().__init__()
+        # Bypass `nn.Module.__setattr__` so the stacked parameters aren't registered as
+        # parameters of the view
+        self.__dict__["_stacked"] = (weight, bias)
+        self.idx = idx
+
+    @property
+    def weight(self) -> th.Tensor:
+        """The weight of this layer's translator."""
+        return self._stacked[0][self.idx]
+
+    @property
+    def bias(self) -> Optional[th.Tensor]:
+        """The bias of this layer's translator, if the lens has one."""
+        bias = self._stacked[1]
+        return bias[self.idx] if bias is not None else None
+
+    def forward(self, h: th.Tensor) -> th.Tensor:
+        """Apply the translator, without the residual connection."""
+        return th.nn.functional.linear(h, self.weight, self.bias)
 
 
 class TunedLens(Lens):
@@ -134,7 +189,8 @@ class TunedLens(Lens):
 
     config: TunedLensConfig
     unembed: Unembed
-    layer_translators: th.nn.ModuleList
+    weight: th.nn.Parameter
+    bias: Optional[th.nn.Parameter]
 
     def __init__(
         self,
@@ -153,28 +209,95 @@ class TunedLens(Lens):
         unembed_hash = unembed.unembedding_hash()
         config.unembed_hash = unembed_hash
 
-        # The unembedding might be int8 if we're using bitsandbytes
-        w = unembed.unembedding.weight
-        dtype = w.dtype if th.is_floating_point(w) else th.float16
-
-        translator = th.nn.Linear(
-            config.d_model, config.d_model, bias=config.bias, dtype=dtype
-        )
-        translator.weight.data.zero_()
-        translator.bias.data.zero_()
+        dtype = _translator_dtype(unembed)
 
-        # Don't include the final layer since it does not need a translator
-        self.layer_translators = th.nn.ModuleList(
-            [deepcopy(translator) for _ in range(self.config.num_hidden_layers)]
+        # Don't include the final layer since it does not need a translator. The
+        # translators of all layers are stacked into a single weight and bias so that
+        # every layer can be transformed with one batched matmul.
+        num_layers, d_model = config.num_hidden_layers, config.d_model
+        self.weight = th.nn.Parameter(
+            th.zeros(num_layers, d_model, d_model, dtype=dtype)
         )
+        if config.bias:
+            self.bias = th.nn.Parameter(th.zeros(num_layers, d_model, dtype=dtype))
+        else:
+            self.register_parameter("bias", None)
 
     def __getitem__(self, item: int) -> th.nn.Module:
-        """Get the probe module at the given index."""
-        return self.layer_translators[item]
+        """Get the translator of the layer at the given index.
+
+        The translators are stored stacked in `weight` and `bias`, so the returned
+        module is a view into them without parameters of its own. Its forward pass is
+        differentiable with respect to the stacked parameters, but to freeze or
+        optimize the translators, use `lens.weight` and `lens.bias` directly.
+        """
+        return _TranslatorView(self.weight, self.bias, item)
 
     def __iter__(self) -> Generator[th.nn.Module, None, None]:
         """Get iterator over the translators within the lens."""
-        yield from self.layer_translators
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def layer_translators(self) -> th.nn.ModuleList:
+        """Deprecated: the translators are now stacked in `weight` and `bias`."""
+        warnings.warn(
+            "TunedLens.layer_translators is deprecated, since the translators are now "
+            "stacked into TunedLens.weight and TunedLens.bias. Its modules are views "
+            "without parameters of their own.",
+            DeprecationWarning,
+            stacklevel=2,
+        )
+        return th.nn.ModuleList(self)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        """Stack translators from state dicts saved before they were stacked.
+
+        Older versions stored the translators as a `layer_translators` ModuleList, so
+        training snapshots contain `layer_translators.{i}.weight` and `.bias` keys.
+        """
+        legacy_prefix = f"{prefix}layer_translators."
+        for name in ("weight", "bias"):
+            keys = [f"{legacy_prefix}{i}.{name}" for i in range(len(self))]
+            if keys and all(key in state_dict for key in keys):
+                layers = [state_dict.pop(key) for key in keys]
+                state_dict[prefix + name] = th.stack(layers)
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _translator_state_dict(self) -> Dict[str, th.Tensor]:
+        """Get the translator parameters in the per-layer checkpoint format.
+
+        Checkpoints use the keys `"{i}.weight"` and `"{i}.bias"` of an `nn.ModuleList`
+        of `nn.Linear` translators, which is how lenses were originally stored.
+        """
+        # The translators may have been upcast to float32 for training, but we store
+        # them in the dtype the lens is created with, like the unembedding
+        dtype = _translator_dtype(self.unembed)
+        state = {}
+        for i in range(len(self)):
+            state[f"{i}.weight"] = self.weight.data[i].to(dtype, copy=True)
+            if self.bias is not None:
+                state[f"{i}.bias"] = self.bias.data[i].to(dtype, copy=True)
+
+        return state
+
+    @th.no_grad()
+    def _load_translator_state_dict(self, state: Dict[str, th.Tensor]) -> None:
+        """Load translator parameters saved in the per-layer checkpoint format."""
+        names = ("weight", "bias") if self.bias is not None else ("weight",)
+        expected = {f"{i}.{name}" for i in range(len(self)) for name in names}
+        missing, unexpected = expected - set(state), set(state) - expected
+        if missing or unexpected:
+            raise RuntimeError(
+                f"Error loading lens checkpoint. Missing keys: {sorted(missing)}. "
+                f"Unexpected keys: {sorted(unexpected)}."
+            )
+
+        for i in range(len(self)):
+            self.weight[i].copy_(state[f"{i}.weight"])
+            if self.bias is not None:
+                self.bias[i].copy_(state[f"{i}.bias"])
 
     @classmethod
     def from_model(
@@ -273,12 +396,16 @@ class TunedLens(Lens):
         lens = cls(unembed, config)
 
         th_load_kwargs = {
-            **{k: v for k, v in kwargs.items() if k not in load_artifact_varnames}
+            # The checkpoint only holds tensors, which we copy into the lens, so we
+            # can skip unpickling arbitrary objects and memory map the file.
+            "weights_only": True,
+            **({"mmap": True} if _th_load_supports_mmap else {}),
+            **{k: v for k, v in kwargs.items() if k not in load_artifact_varnames},
         }
         # Load parameters
         state = th.load(ckpt_path, **th_load_kwargs)
 
-        lens.layer_translators.load_state_dict(state)
+        lens._load_translator_state_dict(state)
 
         return lens
 
@@ -290,6 +417,9 @@ class TunedLens(Lens):
     ) -> None:
         """Save the lens to a directory.
 
+        The translators are saved in the dtype of the unembedding, even if they were
+        upcast to float32 for training.
+
         Args:
             path : The path to the directory to save the lens to.
             ckpt : The name of the checkpoint file to save the parameters to.
@@ -297,7 +427,7 @@ class TunedLens(Lens):
         """
         path = Path(path)
         path.mkdir(exist_ok=True, parents=True)
-        state_dict = self.layer_translators.state_dict()
+        state_dict = self._translator_state_dict()
 
         th.save(state_dict, path / ckpt)
         with open(path / config, "w") as f:
@@ -308,7 +438,31 @@ class TunedLens(Lens):
         # Note that we add the translator output residually, in contrast to the formula
         # in the paper. By parametrizing it this way we ensure that weight decay
         # regularizes the transform toward the identity, not the zero transformation.
-        return h + self[idx](h)
+        bias = self.bias[idx] if self.bias is not None else None
+        return _add_residual(th.nn.functional.linear(h, self.weight[idx], bias), h)
+
+    def transform_hidden_all(self, h: th.Tensor) -> th.Tensor:
+        """Transform the hidden states from every layer with a single batched matmul.
+
+        Args:
+            h: (num_layers x ... x d_model) hidden states, where `h[i]` comes from
+                layer `i` of the transformer.
+
+        Returns:
+            The transformed hidden states, with the same shape as `h`.
+        """
+        if len(h) != len(self):
+            raise ValueError(
+                f"Expected hidden states from {len(self)} layers, got {len(h)}."
+            )
+
+        h_flat = h.reshape(len(h), -1, h.shape[-1])
+        if self.bias is not None:
+            delta = th.baddbmm(self.bias.unsqueeze(1), h_flat, self.weight.mT)
+        else:
+            delta = th.bmm(h_flat, self.weight.mT)
+
+        return _add_residual(delta.view_as(h), h)
 
     def forward(self, h: th.Tensor, idx: int) -> th.Tensor:
         """Transform and then decode the hidden states into logits."""
@@ -317,7 +471,7 @@ class TunedLens(Lens):
 
     def __len__(self) -> int:
         """Return the number of layer translators in the lens."""
-        return len(self.layer_translators)
+        return len(self.weight)
 
     @th.inference_mode()
     def generate(
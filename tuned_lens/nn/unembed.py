@@ -34,6 +34,7 @@ class Unembed(th.nn.Module):
 
     final_norm: model_surgery.Norm
     unembedding: th.nn.Linear
+    _hash_cache: Optional[tuple[tuple[int, int], str]]
 
     def __init__(
         self,
@@ -53,11 +54,30 @@ class Unembed(th.nn.Module):
 
         # In general we don't want to finetune the unembed operation.
         self.requires_grad_(False)
+        self._hash_cache = None
 
     def unembedding_hash(self) -> str:
-        """Hash the unmbedding matrix to identify the model."""
-        parameter = self.unembedding.weight.data.detach().cpu().float().numpy()
-        return tensor_hash(parameter)
+        """Hash the unmbedding matrix to identify the model.
+
+        Hashing copies the whole matrix to the CPU, so the result is cached. The cache
+        is cleared when the module is moved or cast, a state dict is loaded into it, or
+        the weight is modified in place, except through `weight.data`.
+        """
+        weight = self.unembedding.weight
+        key = (weight.data_ptr(), weight._version)
+        if self._hash_cache is None or self._hash_cache[0] != key:
+            parameter = weight.data.detach().cpu().float().numpy()
+            self._hash_cache = (key, tensor_hash(parameter))
+
+        return self._hash_cache[1]
+
+    def _apply(self, *args, **kwargs):
+        self._hash_cache = None
+        return super()._apply(*args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._hash_cache = None
+        return super()._load_from_state_dict(*args, **kwargs)
 
     def forward(self, h: th.Tensor) -> th.Tensor:
         """Convert hidden states into logits."""
@@ -1,5 +1,6 @@
 """Shared configuration for the scripts."""
 import enum
+import inspect
 import logging
 import os
 from dataclasses import dataclass
@@ -18,7 +19,6 @@ from torch.distributed.fsdp import (
 )
 from torch.distributed.fsdp.wrap import transformer_auto_wrap_policy
 from torch.distributed.optim import ZeroRedundancyOptimizer
-from torch.nn.parallel import DistributedDataParallel as DDP
 from torchdata import dataloader2, datapipes
 from transformers import (
     AutoModelForCausalLM,
@@ -266,6 +266,14 @@ class Optimizer:
         else:
             raise ValueError(f"Unknown optimizer '{self.optimizer}'")
 
+        # Fused implementations update all the parameters in a single kernel launch.
+        # Otherwise PyTorch already defaults to the multi-tensor (foreach) kernels on
+        # CUDA. Fused SGD requires PyTorch 2.3 or newer.
+        if all(p.is_cuda for p in params) and (
+            "fused" in inspect.signature(opt_class).parameters
+        ):
+            config["fused"] = True
+
         if self.zero:
             opt = ZeroRedundancyOptimizer(params, optimizer_class=opt_class, **config)
         else:
@@ -361,22 +369,26 @@ class Distributed:
         else:
             return model
 
-    def distribute_lens(self, lens: Lens) -> Union[DDP, Lens]:
-        """Distribute the lens using DistributedDataParallel and send lens to device."""
+    def distribute_lens(self, lens: Lens) -> Lens:
+        """Send the lens to the device of this process.
+
+        We don't wrap the lens in DistributedDataParallel: its parameters are stacked
+        across layers, so the training loop averages their gradients across processes
+        in place, once per optimizer step.
+        """
         logger.debug(f"Sending Lens to device {self.device}")
-        if self.world_size > 1:
-            lens.to(self.device)
-            logger.debug("Distributing the lens across the GPUS using DDP ...")
-            return DDP(lens, device_ids=[self.local_rank], find_unused_parameters=True)
-        else:
-            return lens.to(self.device)
+        return lens.to(self.device)
 
     def dataloader(
         self,
         dataset: Dataset,
     ) -> dataloader2.DataLoader2:
         """Shard the dataset based on local rank."""
-        dp = datapipes.iter.IterableWrapper(dataset)
+        # Shuffle, shard and batch row indices rather than the rows themselves, so
+        # that each batch is read from the dataset with a single indexing call. In the
+        # torch format this returns the stacked tensors directly, instead of building
+        # a dict for every row and collating them.
+        dp = datapipes.iter.IterableWrapper(range(len(dataset)))
         if self.world_size > 1:
             rs = dataloader2.DistributedReadingService()
         else:
@@ -387,7 +399,12 @@ class Distributed:
 
         dp = dp.sharding_filter()
         dp = dp.batch(self.per_gpu_batch_size)
-        dp = dp.collate()
+        dp = dp.map(dataset.__getitem__)
+        if self.device.type == "cuda":
+            # Pin batches in a background thread so they can be copied to the GPU
+            # asynchronously by `send_to_device`
+            dp = dp.pin_memory()
+
         return dataloader2.DataLoader2(dp, reading_service=rs)
 
     def init(self):
@@ -409,5 +426,5 @@ class Distributed:
             dist.barrier()
 
     def send_to_device(self, pytree: TreeType) -> TreeType:
-        """Move pytree to the current device."""
-        return send_to_device(pytree, self.device)
+        """Move pytree to the current device without blocking the host."""
+        return send_to_device(pytree, self.device, non_blocking=True)
@@ -3,10 +3,9 @@ import dataclasses
 import enum
 import logging
 import re
-from collections import defaultdict
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional, Union
+from typing import Callable, Optional, Sequence, Union
 
 import torch as th
 from simple_parsing import field
@@ -14,17 +13,86 @@ from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
 from torch.distributed.optim import ZeroRedundancyOptimizer
 from torch.optim import Optimizer
 from torch.optim.lr_scheduler import LambdaLR
+from torch.utils.checkpoint import checkpoint
 from torchdata.dataloader2 import DataLoader2
 from tqdm.auto import trange
 from transformers import PreTrainedModel
 
 import tuned_lens.scripts.ingredients as ing
 from tuned_lens import TunedLens
-from tuned_lens.utils import maybe_all_reduce, shift_labels, shift_preds
+from tuned_lens.nn import Unembed, linear_cross_entropy, linear_kl_divergence
+from tuned_lens.utils import (
+    maybe_all_reduce,
+    shift_labels,
+    shift_preds,
+)
 
 logger = logging.getLogger(__name__)
 
 
+class _LayerLosses(th.nn.Module):
+    """Module wrapper around `Train._layer_losses` for CUDA graph capture.
+
+    `th.cuda.make_graphed_callables` only takes tensor arguments, and only computes
+    gradients for the parameters of modules, so we bind the lens and shift here.
+    """
+
+    def __init__(self, fn: Callable, lens: TunedLens, shift: int):
+        super().__init__()
+        self.fn = fn
+        self.lens = lens
+        self.shift = shift
+
+    def forward(self, labels: th.Tensor, *hidden_states: th.Tensor) -> th.Tensor:
+        """Compute the loss of the lens at every layer."""
+        return self.fn(self.lens, hidden_states, labels, self.shift)
+
+
+def _graphed(fn: Callable) -> Callable:
+    """Wrap a `Train._layer_losses`-like function to replay it from CUDA graphs.
+
+    The forward and backward graphs are captured on the first call. Calls with other
+    shapes than the first one fall back to running `fn` eagerly. The gradients of the
+    replayed backward pass live in static buffers, so `.grad` must be allocated before
+    each backward pass with `_zero_missing_grads`.
+    """
+    graphed = None
+    shapes = None
+
+    def wrapper(lens, hidden_states, labels, shift):
+        nonlocal graphed, shapes
+
+        args = (labels, *hidden_states)
+        if graphed is None:
+            logger.info("Capturing the lens forward and backward in CUDA graphs...")
+            shapes = [x.shape for x in args]
+            # The sample args become the static inputs of the graphs, so they must not
+            # alias memory that is reused for later batches
+            graphed = th.cuda.make_graphed_callables(
+                _LayerLosses(fn, lens, shift), tuple(x.clone() for x in args)
+            )
+
+        if [x.shape for x in args] != shapes:
+            return fn(lens, hidden_states, labels, shift)
+
+        return graphed(*args)
+
+    return wrapper
+
+
+def _zero_missing_grads(module: th.nn.Module) -> None:
+    """Allocate zeroed gradients for the trainable parameters without a `.grad`.
+
+    Backward passes replayed from CUDA graphs return their gradients in static buffers,
+    which the next replay overwrites. If `.grad` is None, autograd adopts such a buffer
+    as `.grad` instead of copying it, so the next micro-batch would clobber it. With
+    `.grad` allocated, the gradients are accumulated into it in place instead.
+    """
+    for p in module.parameters():
+        if p.requires_grad and p.grad is None:
+            p.grad = th.zeros_like(p)
+
+
 class LossChoice(enum.Enum):
     """Options of what loss to select when training the model."""
 
@@ -48,6 +116,15 @@ class State:
         """Load a snapshot file."""
         logger.info(f"Loading snapshot from {snapshot_file}...")
         snapshot = th.load(snapshot_file, map_location=device)
+        if any("layer_translators." in key for key in snapshot["lens"]):
+            # The optimizer and dataloader states of these snapshots don't match the
+            # stacked translators and the current data pipeline
+            raise ValueError(
+                f"Snapshot {snapshot_file} was saved before the lens translators were "
+                "stacked into a single weight and bias, and cannot be resumed. Start "
+                "a new training run instead."
+            )
+
         self.step = snapshot["step"]
         self.wandb_id = snapshot["wandb_id"]
         self.lens.load_state_dict(snapshot["lens"])
@@ -124,6 +201,16 @@ class Train:
     loss: LossChoice = LossChoice.KL
     """Loss function to use."""
 
+    compile: bool = field(action="store_true")
+    """Compile the lens' forward pass and loss with `torch.compile`. The shapes are the
+    same at every step, so the compiled code is specialized to them."""
+
+    cuda_graphs: bool = field(action="store_true")
+    """Capture the lens' forward and backward passes in CUDA graphs on the first step,
+    and replay them afterwards. This removes the kernel launch overhead, which
+    dominates for the small translator matmuls. With `--compile`, the "reduce-overhead"
+    mode of `torch.compile` is used instead."""
+
     def __post_init__(self):
         """Set defaults for some fields."""
         if self.checkpoint_dir is None:
@@ -138,24 +225,24 @@ class Train:
             logger.info("Loading pretrained lens...")
             lens = TunedLens.from_model_and_pretrained(model, self.lens_name_or_path)
 
-        dtypes = {p.dtype for p in lens.parameters()}
-        assert (
-            len(dtypes) == 1
-        ), f"Expected all parameters to have the same dtype, got {dtypes}"
+        # The lens computes in bfloat16 under autocast, but we keep float32 master
+        # weights for the translators so that small updates aren't rounded away when
+        # the model (and hence the lens by default) is in half precision.
+        translator_params = [p for p in (lens.weight, lens.bias) if p is not None]
+        for p in translator_params:
+            p.data = p.data.float()
 
-        lens_dtype = next(iter(dtypes))
-        lens_size = sum(p.numel() * p.element_size() for p in lens.parameters())
+        lens_size = sum(p.numel() * p.element_size() for p in translator_params)
 
         # Include the optimizer state in the memory usage
         num_bytes = lens_size * (self.opt.per_parameter_optim_state_size() + 1)
         logger.info(
-            f"Tuned lens memory usage: {num_bytes / 2 ** 20:.2f} MB in {lens_dtype}"
+            f"Tuned lens memory usage: {num_bytes / 2 ** 20:.2f} MB in {th.float32}"
         )
 
         if self.bias_only:
             logger.info("Freezing the matrix weights to train only the bias terms.")
-            for probe in lens:
-                probe.weight.requires_grad_(False)
+            lens.weight.requires_grad_(False)
 
         return lens
 
@@ -188,49 +275,146 @@ class Train:
         self,
         opt: th.optim.Optimizer,
         step: int,
-        losses: dict[str, list[float]],
+        losses: th.Tensor,
         tuned_lens: TunedLens,
         nats_to_bpb: float,
     ):
-        """Log statistics about the training process to weights and biases."""
+        """Log statistics about the training process to weights and biases.
+
+        Args:
+            opt: The optimizer of the lens.
+            step: The optimizer step that was just taken.
+            losses: (num_layers x grad_acc_steps) losses of each layer on the batches
+                of this step.
+            tuned_lens: The lens being trained.
+            nats_to_bpb: Ratio to convert the losses from nats to bits per byte.
+        """
         if not self.dist.primary or not self.wandb:
             return
 
         import wandb
 
-        log_dict = {}
-        log_dict.update(
-            {f"loss/{k}": th.tensor(v).mean() * nats_to_bpb for k, v in losses.items()}
-        )
-
-        # Log statistics about optimizer & probes
-        for i, probe in enumerate(tuned_lens):
-            name = "input" if i == 0 else f"{i - 1}.ffn"
-            states = [opt.state[p] for p in probe.parameters()]
-
-            # Approximate the true grad norm using the optimizer's moving
-            # avg
-            corr = 1 - self.opt.momentum**step
-            if self.opt.optimizer == "sgd" and not self.opt.zero:
-                log_dict["grad_norm/" + name] = th.cat(
-                    [
-                        # Undo PyTorch's scaling of the gradient by
-                        # 1 / (1 - β)
-                        (1 - self.opt.momentum) * s["momentum_buffer"].flatten() / corr
-                        for s in states
-                    ]
-                ).norm()
-            elif self.opt.optimizer == "adam" and not self.opt.zero:
-                log_dict["grad_norm/" + name] = th.cat(
-                    [s["exp_avg"].flatten() / corr for s in states]
-                ).norm()
-
-            if isinstance(probe, th.nn.Linear):
-                log_dict["bias_norm/" + name] = probe.bias.data.norm()
-                log_dict["weight_norm/" + name] = probe.weight.data.norm()
+        # Log statistics about the losses, optimizer & probes. We compute the per-layer
+        # values of the stacked tensors all at once and sync with the device a single
+        # time.
+        stats = {"weight_norm": tuned_lens.weight.data.flatten(1).norm(dim=-1)}
+        if tuned_lens.bias is not None:
+            stats["bias_norm"] = tuned_lens.bias.data.norm(dim=-1)
+
+        moving_avg_name = {
+            ing.OptimizerOption.SGD: "momentum_buffer",
+            ing.OptimizerOption.ADAM: "exp_avg",
+        }[self.opt.optimizer]
+        params = [p for p in (tuned_lens.weight, tuned_lens.bias) if p is not None]
+        moving_avgs = [
+            opt.state[p][moving_avg_name]
+            for p in params
+            if not self.opt.zero and moving_avg_name in opt.state.get(p, {})
+        ]
+        if moving_avgs:
+            # Approximate the true grad norm using the optimizer's moving avg,
+            # which has been updated `step + 1` times
+            corr = 1 - self.opt.momentum ** (step + 1)
+            grad_norm = th.stack([m.flatten(1).norm(dim=-1) for m in moving_avgs])
+            grad_norm = grad_norm.norm(dim=0) / corr
+            if self.opt.optimizer == ing.OptimizerOption.SGD:
+                # Undo PyTorch's scaling of the gradient by 1 / (1 - β)
+                grad_norm *= 1 - self.opt.momentum
+
+            stats["grad_norm"] = grad_norm
+
+        loss_values, *stat_values = th.stack(
+            [losses.mean(dim=1) * nats_to_bpb, *stats.values()]
+        ).tolist()
+
+        log_dict = {f"loss/translator_{i}": v for i, v in enumerate(loss_values)}
+        names = ["input" if i == 0 else f"{i - 1}.ffn" for i in range(len(tuned_lens))]
+        for stat, values in zip(stats, stat_values):
+            log_dict.update({f"{stat}/{n}": v for n, v in zip(names, values)})
 
         wandb.log(log_dict)
 
+    def _logits_loss(
+        self, unembed: Unembed, h: th.Tensor, labels: th.Tensor
+    ) -> th.Tensor:
+        """Compute the loss of the lens predictions by materializing the logits."""
+        logits = unembed(h)
+        if self.loss == LossChoice.CE:
+            return th.nn.functional.cross_entropy(
+                logits.flatten(0, -2), labels.flatten()
+            )
+        elif self.loss == LossChoice.KL:
+            # Averaged over positions, since "batchmean" divides by the first dim
+            return th.nn.functional.kl_div(
+                logits.log_softmax(-1).flatten(0, -2),
+                labels.flatten(0, -2),
+                reduction="batchmean",
+                log_target=True,
+            )
+        raise NotImplementedError
+
+    def _loss(self, unembed: Unembed, h: th.Tensor, labels: th.Tensor) -> th.Tensor:
+        """Compute the loss of the lens predictions for each layer.
+
+        Args:
+            unembed: The unembedding to decode the hidden states with.
+            h: (num_layers x batch x seq_len x d_model) transformed hidden states.
+            labels: The labels shared by all layers.
+
+        Returns:
+            The loss of each layer, with shape (num_layers,).
+        """
+        unembedding = unembed.unembedding
+        if not th.is_floating_point(unembedding.weight):
+            # Quantized unembeddings (e.g. bitsandbytes int8) need their own matmul, so
+            # we have to materialize the logits, one layer at a time. They are
+            # recomputed in the backward pass so that we don't keep the logits of every
+            # layer around at once.
+            return th.stack(
+                [
+                    checkpoint(
+                        self._logits_loss, unembed, h_i, labels, use_reentrant=False
+                    )
+                    for h_i in h
+                ]
+            )
+
+        # Compute the loss in chunks over the vocabulary, without ever materializing
+        # the (batch x seq_len x vocab_size) logits. All layers are unembedded
+        # together, so each chunk of the unembedding is only read once.
+        h = unembed.final_norm(h).to(th.bfloat16)
+        if self.loss == LossChoice.CE:
+            return linear_cross_entropy(h, unembedding.weight, unembedding.bias, labels)
+        elif self.loss == LossChoice.KL:
+            return linear_kl_divergence(h, unembedding.weight, unembedding.bias, labels)
+        raise NotImplementedError
+
+    def _layer_losses(
+        self,
+        lens: TunedLens,
+        hidden_states: Sequence[th.Tensor],
+        labels: th.Tensor,
+        shift: int,
+    ) -> th.Tensor:
+        """Compute the loss of the lens at every layer, stacked into a vector."""
+        # We use bfloat16 because it has a larger dynamic range than float16
+        # and it seems to remove the need for doing grad scaling, which is very
+        # annoying to set up.
+        with th.autocast(self.dist.device.type, dtype=th.bfloat16):
+            # Cast each layer before stacking so that the residual stream is written
+            # once, in bfloat16, and transform all layers in one batched matmul
+            stacked = th.stack([h.to(th.bfloat16) for h in hidden_states])
+            transformed = lens.transform_hidden_all(stacked)
+
+            # Shift along the sequence dim, treating the layers as part of the batch
+            transformed = shift_preds(transformed.flatten(0, 1), shift).unflatten(
+                0, transformed.shape[:2]
+            )
+
+            # The loss never materializes the logits, so we can afford to keep
+            # the graphs of all layers around and do a single backward pass.
+            return self._loss(lens.unembed, transformed, labels)
+
     def snapshot(self, state: State):
         """Save a snapshot of the training process to disk."""
         if self.dist.primary:
@@ -335,17 +519,18 @@ class Train:
         logger.debug(f"Creating data loader and setting seed to {self.seed} ...")
         dl = self.dist.dataloader(data)
         dl.seed(self.seed)
+        # Send the lens to its device first, since fused optimizers require it
+        lens = self.dist.distribute_lens(lens)
+
         logger.debug("Creating optimizer and scheduler ...")
         params = [p for p in lens.parameters() if p.requires_grad]
         opt = self.opt.create_optim(params)
         scheduler = self.opt.create_scheduler(opt, self.num_steps)
 
-        ddp_lens = self.dist.distribute_lens(lens)
-
         state = State(
             step=0,
             wandb_id=self._get_wandb_id(),
-            lens=ddp_lens,  # type: ignore
+            lens=lens,
             opt=opt,
             scheduler=scheduler,
             dataloader=dl,
@@ -375,7 +560,22 @@ class Train:
         # Load model, tokenizer, data, and lens
         state, model, grad_acc_steps = self.setup()
 
-        losses = defaultdict(list)
+        if self.cuda_graphs and self.dist.device.type != "cuda":
+            raise ValueError("--cuda_graphs requires a CUDA device.")
+
+        layer_losses_fn = self._layer_losses
+        if self.compile:
+            logger.info("Compiling the lens forward pass and loss...")
+            # This mode replays the compiled code from CUDA graphs
+            mode = "reduce-overhead" if self.cuda_graphs else None
+            layer_losses_fn = th.compile(layer_losses_fn, dynamic=False, mode=mode)
+        elif self.cuda_graphs:
+            layer_losses_fn = _graphed(layer_losses_fn)
+
+        # The loss of each layer on each batch of the current step
+        losses = th.zeros(len(state.lens), grad_acc_steps, device=self.dist.device)
+        # The trainable parameters of the lens, excluding the frozen unembedding
+        params = [p for p in state.lens.parameters() if p.requires_grad]
         init_batches = state.step * grad_acc_steps
         total_batches = self.num_steps * grad_acc_steps
 
@@ -420,45 +620,32 @@ class Train:
 
             labels = shift_labels(labels, shift)
 
-            # We do this sequentially to save VRAM
-            for i, h in enumerate(hidden_states):
-                # We use bfloat16 because it has a larger dynamic range than float16
-                # and it seems to remove the need for doing grad scaling, which is very
-                # annoying to set up in the context of multiple backward passes.
-                with th.autocast(self.dist.device.type, dtype=th.bfloat16):
-                    logits = shift_preds(state.lens(h, idx=i), shift)
-
-                    if self.loss == LossChoice.CE:
-                        loss = th.nn.functional.cross_entropy(
-                            logits.flatten(0, -2), labels.flatten()
-                        )
-                    elif self.loss == LossChoice.KL:
-                        loss = th.sum(
-                            labels.exp() * (labels - logits.log_softmax(-1)), dim=-1
-                        ).mean()
-                    else:
-                        raise NotImplementedError
-
-                    logging_loss = loss.detach()
-                    logging_loss = maybe_all_reduce(logging_loss).item()
-                    if self.dist.primary:
-                        losses[f"translator_{i}"].append(logging_loss)
-
-                    scaled_loss = loss / grad_acc_steps
-
-                scaled_loss.backward()
+            if self.cuda_graphs:
+                # Gradients must be accumulated into `.grad` rather than adopting the
+                # static gradient buffers of the graphs, which the next replay reuses
+                _zero_missing_grads(state.lens)
+
+            layer_losses = layer_losses_fn(state.lens, hidden_states, labels, shift)
+            (layer_losses.sum() / grad_acc_steps).backward()
 
             step, rem = divmod(batch_idx, grad_acc_steps)
+            losses[:, rem] = layer_losses.detach()
+
             if rem == grad_acc_steps - 1:
-                th.nn.utils.clip_grad_norm_(state.lens.parameters(), 1.0)
+                # Average the gradients of the lens across processes ourselves, once
+                # per step instead of once per micro-batch with DDP. Each tensor is
+                # reduced in place, so no extra copy of the gradients is needed.
+                maybe_all_reduce(losses)
+                for p in params:
+                    if p.grad is not None:
+                        maybe_all_reduce(p.grad)
+
+                th.nn.utils.clip_grad_norm_(params, 1.0)
                 state.opt.step()
-                state.opt.zero_grad(set_to_none=False)
+                state.opt.zero_grad(set_to_none=True)
                 state.scheduler.step()
 
-                # Unwrap the lens from DDP if needed
-                lens = getattr(state.lens, "module", state.lens)
-                self._log(state.opt, step, losses, lens, state.nats_to_bpb)
-                losses.clear()
+                self._log(state.opt, step, losses, state.lens, state.nats_to_bpb)
                 state.step = step + 1
                 if (
                     self.checkpoint_freq
@@ -468,7 +655,4 @@ class Train:
 
         if self.dist.primary:
             logger.info(f"Saving lens to {self.output}")
-
-            # Unwrap the lens from DDP if needed
-            lens = getattr(state.lens, "module", state.lens)
-            lens.save(self.output)
+            state.lens.save(self.output)
@@ -246,9 +246,18 @@ def revcumsum(x: Sequence[th.Tensor]) -> list[th.Tensor]:
     return sums
 
 
-def send_to_device(tree: TreeType, device: th.device) -> TreeType:
-    """Recursively send all tensors in a pytree to a device."""
-    return pytree_map(lambda t: t.to(device), tree)
+def send_to_device(
+    tree: TreeType, device: th.device, non_blocking: bool = False
+) -> TreeType:
+    """Recursively send all tensors in a pytree to a device.
+
+    Args:
+        tree: Pytree of tensors to send.
+        device: Device to send the tensors to.
+        non_blocking: Whether to copy asynchronously. Only has an effect for copies
+            from pinned CPU memory to a CUDA device.
+    """
+    return pytree_map(lambda t: t.to(device, non_blocking=non_blocking), tree)
 
 
 def tensor_hash(tensor: NDArray) -> str: